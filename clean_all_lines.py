@@ -35,18 +35,46 @@ Datasets:
 - 2015_SG1: CN_SPW1, CN_SPW3, C18O, 13CO
 """
 
+import glob
+import hashlib
+import importlib.util
+import json
 import os
+import shutil
+import subprocess
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from astropy.io import fits
+
+# Zarr is optional: without it only the FITS products are written.
+try:
+    import zarr
+    from zarr.codecs import BloscCodec
+except ImportError:
+    zarr = None
 
 # ==============================================================================
 #  Load Keplerian Mask Function
 # ==============================================================================
 
-# Load the Keplerian mask function into the global scope
-import sys
-sys.path.insert(0, '/Users/jea/AATau')
-
-with open('/Users/jea/AATau/keplerian_mask.py', 'r') as f:
-    exec(f.read(), globals())
+# Location of this repository, which contains this script and keplerian_mask.py
+REPO_PATH = '/Users/jea/AATau/aatau-alma-analysis'
+
+# Import this repository's keplerian_mask.py as a module so its bytecode is
+# cached between runs. The pipeline relies on its make_pixel_grid,
+# make_image_axes and read_mask functions, so an older copy elsewhere will
+# not work.
+spec = importlib.util.spec_from_file_location("keplerian_mask", os.path.join(REPO_PATH, "keplerian_mask.py"))
+keplerian_mask = importlib.util.module_from_spec(spec)
+sys.modules["keplerian_mask"] = keplerian_mask
+spec.loader.exec_module(keplerian_mask)
+for name in ('make_image_axes', 'make_pixel_grid', 'read_mask'):
+    if not hasattr(keplerian_mask, name):
+        raise ImportError(f"{spec.origin} does not define {name}; use the copy in this repository")
+make_mask = keplerian_mask.make_mask
 print("Successfully loaded make_mask function from keplerian_mask.py")
 
 # ==============================================================================
@@ -84,11 +112,19 @@ TCLEAN_COMMON_PARAMS = {
     'restoringbeam': 'common',
 }
 
+# Dirty clean products reused to start the final clean
+DIRTY_PRODUCTS = ['psf', 'residual', 'pb', 'sumwt', 'weight']
+
 # RMS calculation parameters
-RMS_CHANNELS = '0~30'               # Line-free channels for RMS calculation
+RMS_CHANNELS = range(0, 31)         # Line-free channels (0-30) for RMS calculation
 RMS_MULTIPLIER = 2.0                # Threshold = 2x RMS
 MAX_ITERATIONS = 50000              # Maximum clean iterations
 
+# Parallel processing parameters
+CASA_EXECUTABLE = 'casa'            # Command used to launch worker CASA sessions
+SCRIPT_PATH = os.path.join(REPO_PATH, 'clean_all_lines.py')
+MAX_WORKERS = min(os.cpu_count() or 1, 9)  # One worker per line at most
+
 # Define all datasets to be processed
 DATASETS = [
     {
@@ -168,23 +204,154 @@ DATASETS = [
     },
 ]
 
+# Convert the rest frequencies to Hz once, as expected by make_mask()
+for dataset in DATASETS:
+    for line in dataset['lines']:
+        line['restfreqs_hz'] = np.asarray(line['restfreqs'], dtype=np.float64) * 1e9
+
 # ==============================================================================
 #  Main Processing Function
 # ==============================================================================
 
-def clean_line(base_path, output_path, dataset_config, line_config):
+def params_hash(params):
     """
-    Performs the full cleaning process for a single spectral line.
+    Returns a stable hash of a parameter dictionary.
+    """
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
 
-    Steps:
-    1. Initial dirty clean (niter=0)
-    2. Create Keplerian mask with center offset
-    3. Calculate RMS threshold (2x RMS)
-    4. Final clean with mask
-    5. Export to FITS
+
+def is_cached(product, source, params, params_file):
+    """
+    Returns True if `product` can be reused: it exists, its parameter file is
+    newer than `source`, and it was made with the same `params`.
     """
+    if not (os.path.exists(product) and os.path.exists(params_file)):
+        return False
+    if os.path.getmtime(params_file) <= os.path.getmtime(source):
+        return False
+    with open(params_file, 'r') as f:
+        return json.load(f).get('hash') == params_hash(params)
 
-    # --- Define paths and names ---
+
+def write_params(params_file, params):
+    """
+    Records the parameters used to make a product next to it.
+    """
+    with open(params_file, 'w') as f:
+        json.dump({'hash': params_hash(params), 'params': params}, f, indent=2, sort_keys=True)
+
+
+def remove_params(params_file):
+    """
+    Invalidates a product before it is remade, so that a failed run is never
+    mistaken for a cached one.
+    """
+    if os.path.exists(params_file):
+        os.remove(params_file)
+
+
+def build_pixel_grid():
+    """
+    Deprojects the image pixel grid, which is shared by all lines as they are
+    imaged with the same imsize, cell and disk geometry.
+    """
+    cell = float(TCLEAN_COMMON_PARAMS['cell'].replace('arcsec', ''))
+    x_axis, y_axis = keplerian_mask.make_image_axes(TCLEAN_COMMON_PARAMS['imsize'], cell)
+    return keplerian_mask.make_pixel_grid(
+        x_axis, y_axis,
+        inc=MASK_PARAMS['inc'],
+        PA=MASK_PARAMS['PA'],
+        dist=MASK_PARAMS['dist'],
+        dx0=MASK_PARAMS['dx0'],
+        dy0=MASK_PARAMS['dy0'],
+    )
+
+
+def channel_rms(imagename, channels):
+    """
+    Computes the RMS of an image cube over the given channels.
+
+    The cube is read one channel at a time, accumulating the sum of squares
+    and the number of unmasked pixels, so only a single plane is held in
+    memory. Assumes the tclean axis order [RA, Dec, Stokes, Frequency].
+    """
+    sum_sq = 0.0
+    n_pix = 0
+    ia.open(imagename)
+    try:
+        nx, ny, nstokes, _ = ia.shape()
+        for chan in channels:
+            blc = [0, 0, 0, chan]
+            trc = [nx - 1, ny - 1, nstokes - 1, chan]
+            data = ia.getchunk(blc=blc, trc=trc)
+            good = ia.getchunk(blc=blc, trc=trc, getmask=True)
+            sum_sq += np.square(data[good], dtype=np.float64).sum()
+            n_pix += np.count_nonzero(good)
+    finally:
+        ia.close()
+    return (sum_sq / n_pix) ** 0.5 if n_pix > 0 else 0.0
+
+
+def write_mask_fits(mask, fits_name, template_fits_name):
+    """
+    Writes a boolean mask array to FITS as 8-bit integers (BITPIX = 8).
+
+    `mask` has the CASA axis order (x, y, [stokes], velocity), as returned by
+    make_mask. The Stokes axis is dropped and the WCS is taken from
+    `template_fits_name`, an exported cube on the same grid.
+    """
+    if mask.ndim == 4:
+        mask = mask[:, :, 0, :]
+    header = fits.getheader(template_fits_name)
+    for key in ('BUNIT', 'BTYPE', 'BMAJ', 'BMIN', 'BPA', 'DATAMIN', 'DATAMAX'):
+        header.remove(key, ignore_missing=True)
+    fits.PrimaryHDU(data=mask.T.astype(np.uint8), header=header).writeto(fits_name, overwrite=True)
+
+
+def write_zarr(fits_name):
+    """
+    Writes a Blosc/Zstd compressed Zarr copy of a FITS cube next to it.
+
+    The cube is chunked per channel to match how it is read for moment maps,
+    and the FITS header is stored in the 'fits_header' attribute.
+    """
+    with fits.open(fits_name) as hdul:
+        data = hdul[0].data
+        header = hdul[0].header
+        zarr_name = os.path.splitext(fits_name)[0] + ".zarr"
+        store = zarr.create_array(
+            zarr_name,
+            overwrite=True,
+            shape=data.shape,
+            chunks=(1,) + data.shape[1:],
+            dtype=data.dtype.name,
+            compressors=BloscCodec(cname='zstd', clevel=3, shuffle='shuffle'),
+        )
+        store[:] = data
+        store.attrs['fits_header'] = header.tostring()
+
+
+def reuse_dirty_products(clean0_imagename, clean1_imagename):
+    """
+    Replaces any previous final clean products with copies of the dirty clean
+    products, so that the final clean can start with calcpsf=False and
+    calcres=False.
+    """
+    for product in glob.glob(f"{clean1_imagename}.*"):
+        if os.path.isdir(product):
+            shutil.rmtree(product)
+        else:
+            os.remove(product)
+    for ext in DIRTY_PRODUCTS:
+        dirty_product = f"{clean0_imagename}.{ext}"
+        if os.path.exists(dirty_product):
+            shutil.copytree(dirty_product, f"{clean1_imagename}.{ext}")
+
+
+def vis_path(base_path, dataset_config, line_config):
+    """
+    Returns the path of the continuum-subtracted measurement set of a line.
+    """
     dataset_name_short = dataset_config['name'].replace('_', '')
 
     # Handle the different naming convention for the 2015 dataset
@@ -194,7 +361,44 @@ def clean_line(base_path, output_path, dataset_config, line_config):
         contsub_dir = f"contsub_{dataset_name_short}"
 
     contsub_path = os.path.join(base_path, contsub_dir)
-    vis_file = os.path.join(contsub_path, dataset_config['vis_template'].format(spw=line_config['spw']))
+    return os.path.join(contsub_path, dataset_config['vis_template'].format(spw=line_config['spw']))
+
+
+def last_access(path):
+    """
+    Returns the most recent access time of a measurement set, or 0 if it
+    cannot be read.
+
+    Reading an MS does not update the access time of its directory, so the
+    newest access time of the table files directly inside it is used. On
+    relatime mounts this is only updated about once a day, so it is a rough
+    guide to what is still in the page cache.
+    """
+    try:
+        with os.scandir(path) as entries:
+            return max((entry.stat().st_atime for entry in entries if entry.is_file()),
+                       default=os.path.getatime(path))
+    except OSError:
+        return 0.0
+
+
+def clean_line(base_path, output_path, fits_dir, dataset_config, line_config, pixel_grid=None):
+    """
+    Performs the full cleaning process for a single spectral line.
+
+    `pixel_grid` is the deprojected pixel grid from build_pixel_grid(),
+    reused for the Keplerian mask instead of recomputing it for every line.
+
+    Steps:
+    1. Initial dirty clean (niter=0)
+    2. Create Keplerian mask with center offset
+    3. Calculate RMS threshold (2x RMS)
+    4. Final clean with mask
+    5. Export to FITS
+    """
+
+    # --- Define paths and names ---
+    vis_file = vis_path(base_path, dataset_config, line_config)
 
     # Define output names
     output_prefix = os.path.join(output_path, f"AATau_{line_config['molecule']}_contsub")
@@ -203,92 +407,238 @@ def clean_line(base_path, output_path, dataset_config, line_config):
     clean1_imagename = f"{output_prefix}_clean1"
     clean1_image = f"{clean1_imagename}.image"
     mask_image = f"{clean0_imagename}.mask.image"
+    restfreq_str = f"{line_config['line_freq']:.10g}GHz"
 
     # --- Step 1: Initial dirty clean (niter=0) ---
 
-    tclean(
+    # The dirty cube only depends on the visibilities and the imaging
+    # parameters, so it is reused as long as neither has changed.
+    clean0_params_file = f"{clean0_imagename}.params.json"
+    call0_params = dict(
+        TCLEAN_COMMON_PARAMS,
         vis=vis_file,
         imagename=clean0_imagename,
         width=dataset_config['width'],
-        restfreq=f"{line_config['line_freq']}GHz",
+        restfreq=restfreq_str,
         threshold='5mJy',
         niter=0,
-        **TCLEAN_COMMON_PARAMS
     )
 
+    if is_cached(clean0_image, vis_file, call0_params, clean0_params_file):
+        print(f"Reusing dirty cube {clean0_image}")
+    else:
+        remove_params(clean0_params_file)
+        tclean(**call0_params)
+        write_params(clean0_params_file, call0_params)
+
     # --- Step 2: Create Keplerian mask ---
 
-    make_mask(
-        image=clean0_image,
-        restfreqs=[freq * 1e9 for freq in line_config['restfreqs']],
-        **MASK_PARAMS
-    )
+    # The mask is rebuilt whenever the dirty cube or the mask parameters
+    # change, which is tracked through the dirty cube's parameter file.
+    mask_params_file = f"{mask_image}.params.json"
+    restfreqs = line_config['restfreqs_hz']
+    mask_params = dict(MASK_PARAMS, restfreqs=restfreqs.tolist())
+
+    if is_cached(mask_image, clean0_params_file, mask_params, mask_params_file):
+        print(f"Reusing Keplerian mask {mask_image}")
+        mask = keplerian_mask.read_mask(mask_image)
+    else:
+        remove_params(mask_params_file)
+        _, mask = make_mask(
+            image=clean0_image,
+            restfreqs=restfreqs,
+            precomputed_grid=pixel_grid,
+            return_mask=True,
+            **MASK_PARAMS
+        )
+        write_params(mask_params_file, mask_params)
 
     # --- Step 3: Calculate RMS threshold ---
 
-    stats = imstat(imagename=clean0_image, chans=RMS_CHANNELS)
+    rms_val = channel_rms(clean0_image, RMS_CHANNELS)
 
-    if stats and 'rms' in stats and stats['rms'][0] > 0:
-        rms_val = stats['rms'][0]
-        threshold_val = round(1000. * RMS_MULTIPLIER * rms_val, 1)
-        threshold_str = f'{threshold_val}mJy'
+    if rms_val > 0:
+        threshold_str = f'{1000. * RMS_MULTIPLIER * rms_val:.1f}mJy'
     else:
         threshold_str = '10mJy'
 
     # --- Step 4: Final clean with mask ---
 
-    tclean(
-        vis=vis_file,
+    # The final clean uses the same gridding parameters as the dirty clean,
+    # so start it from the dirty PSF and residual rather than recomputing them
+    reuse_dirty_products(clean0_imagename, clean1_imagename)
+
+    call1_params = dict(
+        call0_params,
         imagename=clean1_imagename,
         mask=mask_image,
-        width=dataset_config['width'],
-        restfreq=f"{line_config['line_freq']}GHz",
         threshold=threshold_str,
         niter=MAX_ITERATIONS,
-        **TCLEAN_COMMON_PARAMS
+        calcpsf=False,
+        calcres=False,
     )
+    tclean(**call1_params)
 
     # --- Step 5: Export to FITS ---
 
-    fits_dir = os.path.join(base_path, "aatau-alma-analysis", "fits_products")
-    if not os.path.exists(fits_dir):
-        os.makedirs(fits_dir)
-
-    # Export cleaned image
     fits_image_name = os.path.join(fits_dir, os.path.basename(clean1_imagename) + ".fits")
+    fits_mask_name = os.path.join(fits_dir, os.path.basename(clean0_imagename) + ".mask.fits")
+
+    # Export the cleaned image
     exportfits(imagename=clean1_image, fitsimage=fits_image_name, overwrite=True, dropstokes=True)
 
-    # Export mask
-    fits_mask_name = os.path.join(fits_dir, os.path.basename(clean0_imagename) + ".mask.fits")
-    exportfits(imagename=mask_image, fitsimage=fits_mask_name, overwrite=True, dropstokes=True)
+    # Write the mask directly from memory, as 8-bit integers since it only
+    # contains 0 and 1
+    write_mask_fits(mask, fits_mask_name, fits_image_name)
 
+    # Keep compressed, per-channel chunked copies for downstream analysis
+    if zarr is not None:
+        for fits_name in (fits_image_name, fits_mask_name):
+            write_zarr(fits_name)
 
-def main():
+
+def line_params(dataset_config, line_config):
     """
-    Main function to loop through all datasets and spectral lines.
+    Returns all the parameters that determine the products of a line.
     """
-    base_path = "/Users/jea/AATau"
-    output_path = os.path.join(base_path, "aatau-alma-analysis", "casa_images")
+    return {
+        'tclean': TCLEAN_COMMON_PARAMS,
+        'mask': MASK_PARAMS,
+        'vis_template': dataset_config['vis_template'],
+        'width': dataset_config['width'],
+        'spw': line_config['spw'],
+        'line_freq': line_config['line_freq'],
+        'restfreqs': line_config['restfreqs'],
+        'rms_channels': list(RMS_CHANNELS),
+        'rms_multiplier': RMS_MULTIPLIER,
+        'max_iterations': MAX_ITERATIONS,
+    }
+
+
+def done_marker(output_path, line_config):
+    """
+    Returns the path of the marker written once a line has been cleaned.
+    """
+    return os.path.join(output_path, f".done_{line_config['molecule']}")
+
+
+def is_done(output_path, dataset_config, line_config):
+    """
+    Returns True if a line was already cleaned with the current parameters.
+    """
+    marker = done_marker(output_path, line_config)
+    if not os.path.exists(marker):
+        return False
+    with open(marker, 'r') as f:
+        return f.read().strip() == params_hash(line_params(dataset_config, line_config))
 
-    # Create output directory if it doesn't exist
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
 
-    # Process all datasets and lines
+def find_line(dataset_name, molecule):
+    """
+    Returns the (dataset_config, line_config) pair for a given dataset name
+    and molecule.
+    """
     for dataset in DATASETS:
+        if dataset['name'] != dataset_name:
+            continue
         for line in dataset['lines']:
-            try:
-                clean_line(base_path, output_path, dataset, line)
-            except Exception:
-                # Continue to next line
+            if line['molecule'] == molecule:
+                return dataset, line
+    raise ValueError(f"Unknown line: {dataset_name} {molecule}")
+
+
+def run_line_worker(output_path, dataset_config, line_config):
+    """
+    Runs clean_line for a single spectral line in a separate CASA session.
+
+    Each line is cleaned in a fresh CASA process rather than a forked copy of
+    this one, since forking is not safe with CASA's C++ state. Each session
+    writes its own log, casa_{molecule}.log in `output_path`, as concurrent
+    sessions would otherwise share the same timestamped default log.
+    """
+    logfile = os.path.join(output_path, f"casa_{line_config['molecule']}.log")
+    command = [
+        CASA_EXECUTABLE, '--nologger', '--nogui', '--logfile', logfile,
+        '-c', SCRIPT_PATH, '--line', dataset_config['name'], line_config['molecule'],
+    ]
+    result = subprocess.run(command)
+    if result.returncode != 0:
+        raise RuntimeError(f"CASA worker exited with status {result.returncode}, see {logfile}")
+
+
+def main():
+    """
+    Main function to clean all datasets and spectral lines.
+
+    When called with `--line <dataset> <molecule>` only that line is cleaned
+    in the current session. Otherwise, each line is dispatched to its own
+    CASA worker session and up to MAX_WORKERS lines are cleaned concurrently.
+    """
+    base_path = "/Users/jea/AATau"
+    output_path = os.path.join(base_path, "aatau-alma-analysis", "casa_images")
+    fits_dir = os.path.join(base_path, "aatau-alma-analysis", "fits_products")
+    grid_file = os.path.join(output_path, "pixel_grid.npz")
+
+    # Worker mode: clean a single line and exit
+    if '--line' in sys.argv:
+        idx = sys.argv.index('--line')
+        dataset, line = find_line(sys.argv[idx + 1], sys.argv[idx + 2])
+        with np.load(grid_file) as grid:
+            pixel_grid = tuple(grid[key] for key in ('r', 't', 'z', 'vkep'))
+        marker = done_marker(output_path, line)
+        if os.path.exists(marker):
+            os.remove(marker)
+        try:
+            clean_line(base_path, output_path, fits_dir, dataset, line, pixel_grid)
+        except (RuntimeError, OSError):
+            print(f"ERROR: cleaning {line['molecule']} failed")
+            traceback.print_exc()
+            sys.exit(1)
+        with open(marker, 'w') as f:
+            f.write(params_hash(line_params(dataset, line)))
+        return
+
+    # Create the output directories once for all lines
+    os.makedirs(output_path, exist_ok=True)
+    os.makedirs(fits_dir, exist_ok=True)
+
+    # Deproject the pixel grid once and share it with all workers
+    r, t, z, vkep = build_pixel_grid()
+    np.savez(grid_file, r=r, t=t, z=z, vkep=vkep)
+
+    # Flatten all datasets into a single task list, starting with the lines
+    # whose measurement sets were read most recently
+    tasks = [(dataset, line) for dataset in DATASETS for line in dataset['lines']]
+    tasks.sort(key=lambda task: last_access(vis_path(base_path, *task)), reverse=True)
+
+    # Process all lines in parallel
+    failed = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {}
+        for dataset, line in tasks:
+            if is_done(output_path, dataset, line):
+                print(f"Skipping {line['molecule']}, already cleaned with the current parameters")
                 continue
+            future = executor.submit(run_line_worker, output_path, dataset, line)
+            futures[future] = line['molecule']
+
+        for future in as_completed(futures):
+            molecule = futures[future]
+            try:
+                future.result()
+                print(f"Finished cleaning {molecule}")
+            except (RuntimeError, OSError) as e:
+                print(f"ERROR: cleaning {molecule} failed: {e}")
+                failed.append(molecule)
 
     print("\n" + "="*80)
     print("ALL CLEANING COMPLETE")
     print("="*80)
+    if failed:
+        print(f"\nFailed lines: {', '.join(failed)}")
     print(f"\nOutput files located in:")
     print(f"  CASA images: {output_path}")
-    print(f"  FITS files: {os.path.join(base_path, 'aatau-alma-analysis', 'fits_products')}")
+    print(f"  FITS files: {fits_dir}")
     print()
 
 
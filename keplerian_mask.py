@@ -10,6 +10,10 @@ Load up the functions.
 > execfile('path/to/keplerian_mask.py')
 > Successfully imported `make_mask`.
 
+or, with CASA 6, import it as a module.
+
+> from keplerian_mask import make_mask
+
 With this loaded, to make a Keplerian mask you will get,
 
 > make_mask(image='image_name.image', inc=30.0, PA=75.0,
@@ -71,10 +75,26 @@ Written by Richard Teague, 2020.
 richard.d.teague@cfa.harvard.edu
 """
 
+import os
 import numpy as np
 import scipy.constants as sc
 import re
 
+# Numba is optional: without it the mask is evaluated with plain NumPy.
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# When imported as a module, rather than run with `execfile` in a CASA
+# session, the CASA tasks and tools have to be imported explicitly.
+try:
+    from casatasks import exportfits, imhead, imsmooth, imstat, rmtables
+    from casatools import image
+    ia = image()
+except ImportError:
+    pass
+
 def _mask_name(imagename):
     """Return a string for the output image name
        for the mask.  Whether the input is .fits
@@ -278,21 +298,6 @@ def _keplerian(r, t, z, mstar, dist, inc):
     return np.sqrt(v) * np.cos(t) * np.sin(np.radians(abs(inc)))
 
 
-def _get_disk_coords(x, y, s, v, dx0, dy0, inc, PA, zr, z_func):
-    """Return the deprojected disk cylindrical coordinates."""
-    rvals, tvals, zvals = _deproject(x=x, y=y, dx0=dx0, dy0=dy0, inc=inc,
-                                     PA=PA, zr=zr, z_func=z_func)
-    rvals = rvals[:, :, None, None] * np.ones((x.size, y.size, s.size, v.size))
-    tvals = tvals[:, :, None, None] * np.ones((x.size, y.size, s.size, v.size))
-    zvals = zvals[:, :, None, None] * np.ones((x.size, y.size, s.size, v.size))
-    return rvals, tvals, zvals
-
-
-def _get_projected_vkep(rvals, tvals, zvals, mstar, dist, inc, vlsr):
-    """Get the projected Keplerian rotation in [m/s]."""
-    return _keplerian(rvals, tvals, zvals, mstar, dist, inc) + vlsr
-
-
 def _get_linewidth(rvals, dV0, dVq):
     """Return the Doppler width in [m/s] of the line at each position."""
     # Avoid divide-by-zero at the origin: 
@@ -302,6 +307,107 @@ def _get_linewidth(rvals, dV0, dVq):
     return linewidth
 
 
+# Deprojected pixel grids, keyed by the image axes and the disk geometry.
+_PIXEL_GRID_CACHE = {}
+
+
+def make_image_axes(imsize, cell):
+    """
+    Make the right ascension and declination offset axes of an image centered
+    on the disk, matching those read from the image header by `_make_axis`.
+
+    Args:
+        imsize (list): Image size in pixels, [nx, ny].
+        cell (float): Pixel size in [arcsec].
+
+    Returns:
+        x_axis, y_axis (ndarrays): Right ascension and declination offsets in
+            [arcsec].
+    """
+    nx, ny = imsize
+    x_axis = (np.arange(nx) - (nx / 2 - 0.5)) * -cell
+    y_axis = (np.arange(ny) - (ny / 2 - 0.5)) * cell
+    return x_axis, y_axis
+
+
+def make_pixel_grid(x_axis, y_axis, inc, PA, dist, dx0=0.0, dy0=0.0, zr=0.0,
+                    z_func=None):
+    """
+    Deproject the pixel grid of an image. As this only depends on the image
+    axes and the disk geometry, the result is cached and can be shared between
+    all lines imaged on the same grid.
+
+    Args:
+        x_axis (array): Right ascension axis in [arcsec].
+        y_axis (array): Declination axis in [arcsec].
+        inc, PA, dist, dx0, dy0, zr, z_func: As in `make_mask`.
+
+    Returns:
+        rvals, tvals, zvals, vkep (ndarrays): Radius, azimuth and height of
+            each pixel in [arcsec], [rad], [arcsec], and the projected
+            Keplerian velocity in [m/s] for a 1 Msun star, each with shape
+            (nx, ny).
+    """
+    key = (np.asarray(x_axis).tobytes(), np.asarray(y_axis).tobytes(),
+           inc, PA, dist, dx0, dy0, zr, z_func)
+    if key not in _PIXEL_GRID_CACHE:
+        r, t, z = _deproject(x=x_axis, y=y_axis, dx0=dx0, dy0=dy0, inc=inc,
+                             PA=PA, zr=zr, z_func=z_func)
+        r, t, z = [np.ascontiguousarray(a) for a in (r, t, z)]
+        vkep = _keplerian(r, t, z, 1.0, dist, inc)
+        _PIXEL_GRID_CACHE[key] = (r, t, z, vkep)
+    return _PIXEL_GRID_CACHE[key]
+
+
+def _mask_core(rvals, vkep, v_axis, mstar, vlsr, dV0, dVq, r_min, r_max,
+               dvchan):
+    """
+    Evaluate the Keplerian mask for a deprojected pixel grid. All arrays and
+    scalars are expected as float32, which is ample precision for comparing
+    velocities to the ~100 m/s channel and line widths.
+
+    Args:
+        rvals (ndarray): Deprojected radius of each pixel with shape (nx, ny)
+            in [arcsec].
+        vkep (ndarray): Projected Keplerian velocity of each pixel for a 1 Msun
+            star in [m/s].
+        v_axis (ndarray): Velocity axis in [m/s].
+        mstar, vlsr, dV0, dVq, r_min, r_max: As in `make_mask`.
+        dvchan (float): Half the channel width in [m/s].
+
+    Returns:
+        mask (ndarray): Boolean mask with shape (nx, ny, nv).
+    """
+    vkep = np.sqrt(mstar) * vkep + vlsr
+    dV = _get_linewidth(rvals, dV0, dVq) + dvchan
+    r_mask = np.logical_and(rvals >= r_min, rvals <= r_max)
+    v_mask = abs(v_axis[None, None, :] - vkep[:, :, None]) < dV[:, :, None]
+    return np.logical_and(r_mask[:, :, None], v_mask)
+
+
+if numba is not None:
+    # Cache the compiled kernel on disk so that separate CASA sessions do not
+    # each pay for the JIT compilation.
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _mask_core(rvals, vkep, v_axis, mstar, vlsr, dV0, dVq, r_min, r_max,
+                   dvchan):
+        """Numba version of `_mask_core`, parallelized over pixel rows."""
+        nx, ny = rvals.shape
+        nv = v_axis.size
+        vscale = np.sqrt(mstar)
+        mask = np.zeros((nx, ny, nv), dtype=np.bool_)
+        for i in numba.prange(nx):
+            for j in range(ny):
+                r = rvals[i, j]
+                if r < r_min or r > r_max:
+                    continue
+                vp = vscale * vkep[i, j] + vlsr
+                dV = dvchan if r == 0 else dV0 * r**dVq + dvchan
+                for k in range(nv):
+                    mask[i, j, k] = abs(v_axis[k] - vp) < dV
+        return mask
+
+
 def _trim_name(image):
     """Remove the slash at the end of the filename."""
     return image[:-1] if image[-1] == '/' else image
@@ -392,6 +498,23 @@ def _make_zr_list(zr, max_dzr=0.1):
     return np.linspace(a[0], a[-1], a.size)
 
 
+def read_mask(image):
+    """
+    Read a mask image into a boolean array.
+
+    Args:
+        image (str): Path to the mask image.
+
+    Returns:
+        mask (ndarray): Boolean array of the masked values, with the axes of
+            the image in CASA order, e.g. (x, y, stokes, velocity).
+    """
+    ia.open(image)
+    mask = ia.getchunk() > 0.5
+    ia.close()
+    return mask
+
+
 def _save_as_mask(image, tolerance=0.01):
     """
     Convert the provided image file in-place to a boolean mask.
@@ -413,7 +536,8 @@ def make_mask(inc, PA, dist, mstar, vlsr, dx0=0.0, dy0=0.0, zr=0.0,
               image=None, x_axis=None, y_axis=None, s_axis=None, v_axis=None,
               z_func=None, dV0=300.0, dVq=-0.5, r_min=0.0, r_max=4.0,
               nbeams=None, target_res=None, tolerance=0.01, restfreqs=None,
-              estimate_rms=True, max_dzr=0.2, export_FITS=False):
+              estimate_rms=True, max_dzr=0.2, export_FITS=False,
+              precomputed_grid=None, return_mask=False):
     """
     Make a Keplerian mask for CLEANing.
 
@@ -464,9 +588,17 @@ def make_mask(inc, PA, dist, mstar, vlsr, dx0=0.0, dy0=0.0, zr=0.0,
         max_dzr (optional[float]): Maximum spacing in zr to use when filling in
             the image plane for highly elevated models.
         export_FITS (optional[bool]): If True, export the mask as a FITS file.
+        precomputed_grid (optional[tuple]): The deprojected pixel grid returned
+            by `make_pixel_grid`. If provided, this is used instead of
+            deprojecting the image axes, and `zr` and `z_func` are ignored.
+        return_mask (optional[bool]): If True, also return the final mask as a
+            boolean array.
 
     Returns (if `image` is not None):
         rms (float): The RMS of the masked regions if `estimate_rms` is True.
+        mask (ndarray): The final boolean mask, after any convolution, with
+            the axes of the mask image if `return_mask` is True. If both are
+            requested, returns `(rms, mask)`.
 
     Return (if `image` is None):
         mask (ndarray): Numpy boolean array of the masked values.
@@ -479,22 +611,32 @@ def make_mask(inc, PA, dist, mstar, vlsr, dx0=0.0, dy0=0.0, zr=0.0,
         raise ValueError("Must provide all four image axes.")
     dvchan = 0.5 * abs(np.diff(v_axis).mean())
 
-    # Define the rest frequencies and cycle through them.
+    # Deproject the pixel grid for each emission surface.
+    if precomputed_grid is not None:
+        if precomputed_grid[0].shape != (x_axis.size, y_axis.size):
+            raise ValueError("`precomputed_grid` does not match the image axes.")
+        grids = [precomputed_grid]
+    else:
+        zr_list = _make_zr_list(zr, max_dzr) if z_func is None else [-1., 0., 1.]
+        grids = [make_pixel_grid(x_axis, y_axis, inc, PA, dist, dx0, dy0, zr,
+                                 z_func) for zr in zr_list]
+
+    # Cycle through the emission surfaces and rest frequencies. The mask is
+    # evaluated in single precision.
     mask = None
-    zr_list = _make_zr_list(zr, max_dzr) if z_func is None else [-1., 0., 1.]
-    for offset in _get_offsets(image, restfreqs):
-        for zr in zr_list:
-            r, t, z = _get_disk_coords(x_axis, y_axis, s_axis, v_axis,
-                                       dx0, dy0, inc, PA, zr, z_func)
-            vkep = _get_projected_vkep(r, t, z, mstar, dist, inc, vlsr+offset)
-            dV = _get_linewidth(r, dV0, dVq)
-            r_mask = np.logical_and(r >= r_min, r <= r_max)
-            v_mask = abs(v_axis[None, None, None, :] - vkep) < dV + dvchan
-            tmp_mask = np.logical_and(r_mask, v_mask)
-            if mask is None:
-                mask = np.where(tmp_mask, 1.0, 0.0)
-            else:
-                mask = np.where(np.logical_or(mask, tmp_mask), 1.0, 0.0)
+    f32 = np.float32
+    offsets = _get_offsets(image, restfreqs)
+    v_axis32 = np.asarray(v_axis, dtype=f32)
+    for r, _, _, vkep in grids:
+        r, vkep = r.astype(f32), vkep.astype(f32)
+        for offset in offsets:
+            tmp_mask = _mask_core(r, vkep, v_axis32, f32(mstar),
+                                  f32(vlsr+offset), f32(dV0), f32(dVq),
+                                  f32(r_min), f32(r_max), f32(dvchan))
+            mask = tmp_mask if mask is None else np.logical_or(mask, tmp_mask)
+
+    # Broadcast the mask over the Stokes axis.
+    mask = np.where(mask[:, :, None, :], 1.0, 0.0) * np.ones(s_axis.size)[None, None, :, None]
 
     # If any image was not specified, we return the array here.
     if image is None:
@@ -518,6 +660,7 @@ def make_mask(inc, PA, dist, mstar, vlsr, dx0=0.0, dy0=0.0, zr=0.0,
                    dropstokes=dropstokes)
 
     # Estimate the RMS of the un-masked pixels.
+    rms = None
     if estimate_rms:
         rms = imstat(imagename=image, mask='"{}" < 1.0'.format(mask_filename))['rms'][0]
         print_rms = rms if rms > 1e-2 else rms * 1e3
@@ -525,6 +668,12 @@ def make_mask(inc, PA, dist, mstar, vlsr, dx0=0.0, dy0=0.0, zr=0.0,
         print("# Estimated RMS of unmasked regions: " +
               "{:.2f} {}/beam".format(print_rms, print_unit))
         print("# If there are strong sidelobes this may overestimate the RMS.")
+
+    # Return the final mask in memory if requested.
+    if return_mask:
+        mask = read_mask(mask_filename)
+        return (rms, mask) if estimate_rms else mask
+    if estimate_rms:
         return rms
 
 